@@ -5,17 +5,214 @@ date: 2024-10-26
 version: 1.0
 license: MIT
 description: A pipeline for generating text using AWS Bedrock models in Open-WebUI.
-requirements: boto3
+requirements: boto3, orjson, requests
 environment_variables: AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION
 """
 
-from typing import List, Union, Iterator
+from typing import Callable, Dict, List, NamedTuple, Tuple, Union, Iterator
 import os
-import json
-import boto3
+import logging
+import asyncio
+import orjson
 import base64
+import random
+import requests
+import time
+from functools import lru_cache, partial
 from pydantic import BaseModel
-import traceback
+
+logger = logging.getLogger(__name__)
+
+# Keep-alive connections and a pool large enough for concurrent requests.
+# Only used for the runtime client, the control plane client is barely used.
+_RUNTIME_CONFIG = {
+    "max_pool_connections": 64,
+    "tcp_keepalive": True,
+    "retries": {"mode": "adaptive", "max_attempts": 5},
+}
+
+# Image downloads reuse pooled connections, read in multiples of 3 bytes
+_http = requests.Session()
+_IMAGE_CHUNK_SIZE = 3 * 21845
+_IMAGE_MEDIA_TYPES = {"image/jpeg", "image/png", "image/gif", "image/webp"}
+
+# Model lists fetched from the control plane, by credentials fingerprint.
+# Only successful fetches are cached, failures are retried on the next update.
+MODEL_CACHE_TTL = 3600
+_MODEL_CACHE: Dict[tuple, Tuple[float, List[dict]]] = {}
+
+# Attempts at listing models while credentials can't be retrieved
+CREDENTIAL_RETRIES = 3
+
+
+@lru_cache(maxsize=None)
+def _boto3():
+    """Import boto3 on first use, it is slow to import and only needed once clients are built."""
+    import boto3
+
+    return boto3
+
+
+@lru_cache(maxsize=None)
+def _get_session(region: str, access_key: str, secret_key: str):
+    """Return a shared Boto3 session for the given region and credentials."""
+    return _boto3().Session(
+        region_name=region,
+        aws_access_key_id=access_key,
+        aws_secret_access_key=secret_key,
+    )
+
+
+@lru_cache(maxsize=None)
+def _get_client(service: str, region: str, access_key: str, secret_key: str):
+    """Return a shared Boto3 client, built once per service, region and credentials."""
+    from botocore.config import Config
+
+    config = Config(**_RUNTIME_CONFIG) if service == "bedrock-runtime" else None
+    return _get_session(region, access_key, secret_key).client(service, config=config)
+
+
+def _build_amazon(messages: List[dict], body: dict, max_tokens: int, temperature: float) -> dict:
+    return {
+        "inputText": "".join(f"{message['content']} " for message in messages if message["role"] == "user"),
+        "textGenerationConfig": {
+            "maxTokenCount": max_tokens,
+            "stopSequences": [],
+            "temperature": temperature
+        }
+    }
+
+
+def _sniff_image_type(head: bytes) -> str:
+    """Guess the media type from the file signature, defaulting to JPEG."""
+    if head.startswith(b"\x89PNG"):
+        return "image/png"
+    if head.startswith(b"GIF8"):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+def _download_image_base64(url: str) -> Tuple[str, str]:
+    """Download an image, returning its media type and base64 data encoded as it arrives."""
+    encoded = bytearray()
+    pending = b""
+    head = b""
+    with _http.get(url, stream=True, timeout=30) as response:
+        response.raise_for_status()
+        media_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        for chunk in response.iter_content(_IMAGE_CHUNK_SIZE):
+            if len(head) < 12:
+                head += chunk[:12 - len(head)]
+            # Encode only whole 3-byte groups so the pieces join without padding
+            pending += chunk
+            cut = len(pending) - len(pending) % 3
+            encoded += base64.b64encode(pending[:cut])
+            pending = pending[cut:]
+    encoded += base64.b64encode(pending)
+
+    # Storage and CDNs often send generic types such as application/octet-stream
+    if media_type not in _IMAGE_MEDIA_TYPES:
+        media_type = _sniff_image_type(head)
+    return media_type, encoded.decode("ascii")
+
+
+def _build_anthropic(messages: List[dict], body: dict, max_tokens: int, temperature: float) -> dict:
+    # Handle image if present in the last user message
+    image = None
+    if messages and messages[-1]["role"] == "user" and body.get("image_url"):
+        image_url = body["image_url"]
+        try:
+            media_type, image_data = _download_image_base64(image_url)
+            image = {"type": "image", "source": {"type": "base64", "media_type": media_type, "data": image_data}}
+        except requests.exceptions.RequestException as e:
+            logger.warning("Could not download image: %s", e)
+
+    # Construct messages for Anthropic
+    anthropic_messages = []
+    last_index = len(messages) - 1
+    for i, message in enumerate(messages):
+        if message["role"] == "user":
+            content = [image] if image and i == last_index else []
+            content.append({"type": "text", "text": message["content"]})
+            anthropic_messages.append({"role": "user", "content": content})
+        elif message["role"] == "assistant":
+            anthropic_messages.append({"role": "assistant", "content": message["content"]})
+
+    return {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": max_tokens,
+        "messages": anthropic_messages,
+        "temperature": temperature,
+    }
+
+
+def _build_role_prompt(
+    messages: List[dict], body: dict, max_tokens: int, temperature: float, max_tokens_key: str
+) -> dict:
+    return {
+        "prompt": "".join(f"{message['role']}: {message['content']}\n" for message in messages),
+        "temperature": temperature,
+        max_tokens_key: max_tokens,
+    }
+
+
+def _build_mistral(messages: List[dict], body: dict, max_tokens: int, temperature: float) -> dict:
+    prompt = "".join(
+        f"[INST] {message['content']} [/INST]" if message["role"] == "user" else message["content"]
+        for message in messages
+        if message["role"] in ("user", "assistant")
+    )
+    return {
+        "prompt": prompt,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+    }
+
+
+class _Provider(NamedTuple):
+    """Request and response handling for one model provider."""
+    build: Callable[[List[dict], dict, int, float], dict]
+    extract: Callable[[dict], str]
+    extract_chunk: Callable[[dict], str]
+
+
+# Handlers by model provider, the prefix of the model id
+_PROVIDERS = {
+    "amazon": _Provider(
+        _build_amazon,
+        lambda jsondata: jsondata['results'][0]['outputText'],
+        lambda data: data.get("outputText", ""),
+    ),
+    "anthropic": _Provider(
+        _build_anthropic,
+        lambda jsondata: jsondata['content'][0]['text'],
+        # Messages API: only content_block_delta events carry text
+        lambda data: data["delta"].get("text", "") if data.get("type") == "content_block_delta" else "",
+    ),
+    "ai21": _Provider(
+        partial(_build_role_prompt, max_tokens_key="maxTokens"),
+        lambda jsondata: jsondata['completions'][0]['data']['text'],
+        lambda data: data.get("completions", [{}])[0].get("data", {}).get("text", ""),
+    ),
+    "cohere": _Provider(
+        partial(_build_role_prompt, max_tokens_key="max_tokens"),
+        lambda jsondata: jsondata['generations'][0]['text'],
+        lambda data: data.get("text") or data.get("generations", [{}])[0].get("text", ""),
+    ),
+    "meta": _Provider(
+        partial(_build_role_prompt, max_tokens_key="max_gen_len"),
+        lambda jsondata: jsondata['generation'],
+        lambda data: data.get("generation", ""),
+    ),
+    "mistral": _Provider(
+        _build_mistral,
+        lambda jsondata: jsondata['outputs'][0]['text'],
+        lambda data: data.get("outputs", [{}])[0].get("text", ""),
+    ),
+}
+
 
 class Pipeline:
     """AWS Bedrock pipeline"""
@@ -25,6 +222,7 @@ class Pipeline:
         AWS_ACCESS_KEY_ID: str
         AWS_SECRET_ACCESS_KEY: str
         AWS_REGION: str
+        STREAM_CHUNK_SIZE: int = 64
 
     def __init__(self):
         self.type = "manifold"
@@ -41,56 +239,68 @@ class Pipeline:
         self.pipelines = []
 
         # Initialize the Boto3 client for Bedrock and runtime
-        self.client = boto3.client(
-            "bedrock",
-            region_name=self.valves.AWS_REGION,
-            aws_access_key_id=self.valves.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=self.valves.AWS_SECRET_ACCESS_KEY
-        )
-        self.runtime_client = boto3.client(
-            "bedrock-runtime",
-            region_name=self.valves.AWS_REGION,
-            aws_access_key_id=self.valves.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=self.valves.AWS_SECRET_ACCESS_KEY
-        )
-        
+        self._creds_fingerprint = self._credentials_fingerprint()
+        self._set_clients()
         self.update_pipelines()
 
     async def on_startup(self) -> None:
         """Called when the server is started."""
-        print(f"on_startup: {__name__}")
+        logger.info("on_startup: %s", __name__)
 
     async def on_shutdown(self) -> None:
         """Called when the server is stopped."""
-        print(f"on_shutdown: {__name__}")
+        logger.info("on_shutdown: %s", __name__)
 
     async def on_valves_updated(self) -> None:
         """Called when the valves are updated."""
-        print(f"on_valves_updated: {__name__}")
-        self.client = boto3.client(
-            "bedrock",
-            region_name=self.valves.AWS_REGION,
-            aws_access_key_id=self.valves.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=self.valves.AWS_SECRET_ACCESS_KEY
-        )
-        self.runtime_client = boto3.client(
-            "bedrock-runtime",
-            region_name=self.valves.AWS_REGION,
-            aws_access_key_id=self.valves.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=self.valves.AWS_SECRET_ACCESS_KEY
+        logger.info("on_valves_updated: %s", __name__)
+        fingerprint = self._credentials_fingerprint()
+        fetch_failed = any(pipeline["id"] == "error" for pipeline in self.pipelines)
+        if fingerprint == self._creds_fingerprint and not fetch_failed:
+            # Same region and credentials, keep the clients and their open connections
+            return
+
+        if fingerprint != self._creds_fingerprint:
+            # Drop the sessions, clients and connection pools held for the old credentials.
+            # Other instances keep their own references to the clients they use.
+            _get_client.cache_clear()
+            _get_session.cache_clear()
+            _MODEL_CACHE.pop(self._creds_fingerprint, None)
+
+        self._creds_fingerprint = fingerprint
+        self._set_clients()
+        # Model listing may back off and sleep, keep it off the event loop
+        await asyncio.to_thread(self.update_pipelines)
+
+    def _credentials_fingerprint(self) -> tuple:
+        """Return the (region, access key, secret key) the clients are built from."""
+        return (
+            self.valves.AWS_REGION,
+            self.valves.AWS_ACCESS_KEY_ID,
+            self.valves.AWS_SECRET_ACCESS_KEY,
         )
-        self.update_pipelines()
+
+    def _set_clients(self) -> None:
+        """Point the Bedrock clients at the shared clients for the current valves."""
+        self.client = _get_client("bedrock", *self._creds_fingerprint)
+        self.runtime_client = _get_client("bedrock-runtime", *self._creds_fingerprint)
 
     def update_pipelines(self) -> None:
         """Update available models from AWS Bedrock."""
+        cached = _MODEL_CACHE.get(self._creds_fingerprint)
+        if cached and time.monotonic() - cached[0] < MODEL_CACHE_TTL:
+            self.pipelines = cached[1]
+            return
+
         try:
-            models = self.client.list_foundation_models(byInferenceType='ON_DEMAND', byOutputModality='TEXT')["modelSummaries"]
+            models = self._list_foundation_models()
             self.pipelines = [
                 {"id": model["modelId"], "name": model["modelName"]}
                 for model in models
             ]
+            _MODEL_CACHE[self._creds_fingerprint] = (time.monotonic(), self.pipelines)
         except Exception as e:
-            print(f"Failed to fetch models: {e}")
+            logger.error("Failed to fetch models: %s", e)
             self.pipelines = [
                 {
                     "id": "error",
@@ -98,172 +308,100 @@ class Pipeline:
                 }
             ]
 
+    def _list_foundation_models(self) -> List[dict]:
+        """List on-demand text models, retrying while credentials can't be retrieved yet."""
+        from botocore.exceptions import CredentialRetrievalError
+
+        for attempt in range(CREDENTIAL_RETRIES):
+            try:
+                return self.client.list_foundation_models(byInferenceType='ON_DEMAND', byOutputModality='TEXT')["modelSummaries"]
+            except CredentialRetrievalError:
+                # The instance metadata service throttles under load, back off and retry
+                if attempt == CREDENTIAL_RETRIES - 1:
+                    raise
+                time.sleep(2 ** attempt * 0.5 + random.random() * 0.1)
+
     def pipe(
         self, user_message: str, model_id: str, messages: List[dict], body: dict
     ) -> Union[str, Iterator]:
         try:
+            # Bedrock model ids are "<provider>.<model>"
+            provider = model_id.partition(".")[0]
+
             # Format the request body based on the model and messages
-            payload = self._format_message(model_id, messages, body)
+            payload = self._format_message(provider, messages, body)
 
             accept = "application/json"
             content_type = "application/json"
-            # Known issue - streaming doesn't work due to invoke_model_with_response_stream compatibility. 
-            # if body.get("stream", False): 
-            #     response = self.runtime_client.invoke_model_with_response_stream(
-            #         body=payload.encode("utf-8"),
-            #         modelId=model_id,
-            #         accept=accept,
-            #         contentType=content_type,
-            #     )
-            #     return self._stream_response(response, model_id.split(".")[0])
-            # else:
+            if body.get("stream", False):
+                response = self.runtime_client.invoke_model_with_response_stream(
+                    body=payload,
+                    modelId=model_id,
+                    accept=accept,
+                    contentType=content_type,
+                )
+                return self._stream_response(response, provider)
+
             response = self.runtime_client.invoke_model(
-                body=payload.encode("utf-8"),
+                body=payload,
                 modelId=model_id,
                 accept=accept,
                 contentType=content_type,
             )
-            response_body = json.loads(response.get("body").read())
-            return self._extract_output(response_body, model_id)
+            return self._extract_output(orjson.loads(response["body"].read()), provider)
 
         except Exception as e:
-            print(f"Error generating content: {e}")
-            traceback.print_exc()
+            logger.exception("Error generating content")
             return f"An error occurred: {str(e)}"
 
-    def _format_message(self, model: str, messages: List[dict], body: dict) -> str:
-        """Format the message based on the model and list of messages."""
+    async def apipe(
+        self, user_message: str, model_id: str, messages: List[dict], body: dict
+    ) -> Union[str, Iterator]:
+        """Run pipe() in a worker thread so async callers don't block the event loop.
+
+        A streamed response is still a regular iterator, which should be consumed off the loop.
+        """
+        return await asyncio.to_thread(self.pipe, user_message, model_id, messages, body)
+
+    def _format_message(self, provider: str, messages: List[dict], body: dict) -> bytes:
+        """Format the message based on the model provider and list of messages."""
+        if provider not in _PROVIDERS:
+            raise ValueError(f"Unsupported model provider: {provider}")
+        builder = _PROVIDERS[provider].build
+
         max_tokens = body.get("max_tokens", 2048)
         temperature = body.get("temperature", 0.5)
+        return orjson.dumps(builder(messages, body, max_tokens, temperature))
 
-        if 'amazon' in model:
-            prompt = ""
-            for message in messages:
-                if message["role"] == "user":
-                    prompt += f"{message['content']} "
-            return json.dumps({
-                "inputText": prompt,
-                "textGenerationConfig": {
-                    "maxTokenCount": max_tokens,
-                    "stopSequences": [],
-                    "temperature": temperature
-                }
-            })
-        elif 'anthropic' in model:
-            # Handle image if present in the last user message
-            content = []
-            if messages and messages[-1]["role"] == "user" and body.get("image_url"):
-                image_url = body["image_url"]
-                try:
-                    import requests
-                    from io import BytesIO
-
-                    response = requests.get(image_url)
-                    response.raise_for_status()
-                    image_data = base64.b64encode(response.content).decode('utf-8')
-                    content.append({"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": image_data}})
-                except requests.exceptions.RequestException as e:
-                    print(f"Error: Could not download image: {e}")
-            
-            # Construct messages for Anthropic
-            anthropic_messages = []
-            for message in messages:
-                if message["role"] == "user":
-                    content.append({"type": "text", "text": message["content"]})
-                    anthropic_messages.append({"role": "user", "content": content})
-                elif message["role"] == "assistant":
-                    anthropic_messages.append({"role": "assistant", "content": message["content"]})
-
-            return json.dumps({
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": max_tokens,
-                "messages": anthropic_messages,
-                "temperature": temperature,
-            })
-        elif 'ai21' in model:
-            prompt = ""
-            for message in messages:
-                prompt += f"{message['role']}: {message['content']}\n"
-            return json.dumps({
-                "prompt": prompt,
-                "temperature": temperature,
-                "maxTokens": max_tokens,
-            })
-        elif 'cohere' in model:
-            prompt = ""
-            for message in messages:
-                prompt += f"{message['role']}: {message['content']}\n"
-            return json.dumps({
-                "prompt": prompt,
-                "temperature": temperature,
-                "max_tokens": max_tokens,
-            })
-        elif 'meta' in model:
-            prompt = ""
-            for message in messages:
-                prompt += f"{message['role']}: {message['content']}\n"
-            return json.dumps({
-                "prompt": prompt,
-                "temperature": temperature,
-                "max_gen_len": max_tokens
-            })
-        elif 'mistral' in model:
-            prompt = ""
-            for message in messages:
-                if message["role"] == "user":
-                    prompt += f"[INST] {message['content']} [/INST]"
-                elif message["role"] == "assistant":
-                    prompt += f"{message['content']}"
-            return json.dumps({
-                "prompt": prompt,
-                "max_tokens": max_tokens,
-                "temperature": temperature,
-            })
-        else:
-            return ""
-
-    def _extract_output(self, jsondata: dict, model: str) -> str:
+    def _extract_output(self, jsondata: dict, provider: str) -> str:
         """Extract the output from the model response."""
-        if 'amazon' in model:
-            return jsondata['results'][0]['outputText']
-        elif 'anthropic' in model:
-            return jsondata['content'][0]['text']
-        elif 'ai21' in model:
-            return jsondata.get('completions')[0].get('data').get('text')
-        elif 'cohere' in model:
-            return jsondata['generations'][0]['text']
-        elif 'meta' in model:
-            return jsondata['generation']
-        elif 'mistral' in model:
-            return jsondata['outputs'][0]['text']
-        else:
-            return ""
-
-    def _stream_response(self, response, model_provider: str):
-        """Stream the response chunks."""
-        if model_provider == "anthropic":
-            for event in response["body"]:
-                data = json.loads(event["chunk"]["bytes"])
-                yield data.get("completion", "")
-        elif model_provider == "mistral":
-            event_stream = response.get('body')
-            for b in iter(event_stream):
-                bc = b['chunk']['bytes']
-                gen = json.loads(bc.decode('utf-8'))
-                line = gen.get('outputs', [{}])[0].get('text', "")
-                if '\n' == line:
-                    yield ''
-                else:
-                    yield line
-        elif model_provider == "cohere":
-            for event in response["body"]:
-                data = json.loads(event["chunk"]["bytes"])
-                yield data.get('text', "")
-        elif model_provider == "meta":
-            for event in response["body"]:
-                data = json.loads(event["chunk"]["bytes"].decode("utf-8"))
-                yield data.get('generation', "")
-        else:  # Default streaming for other models
+        return _PROVIDERS[provider].extract(jsondata)
+
+    def _stream_response(self, response, provider: str) -> Iterator[str]:
+        """Stream the text of the response, coalesced into chunks of about STREAM_CHUNK_SIZE characters."""
+        extract_chunk = _PROVIDERS[provider].extract_chunk
+        buffer = []
+        buffered = 0
+        try:
             for event in response["body"]:
-                chunk = event["chunk"]["bytes"].decode("utf-8")
-                yield chunk
+                if "chunk" not in event:
+                    continue
+                text = extract_chunk(orjson.loads(event["chunk"]["bytes"]))
+                if not text:
+                    continue
+                buffer.append(text)
+                buffered += len(text)
+                # Flush on a full chunk or a line break so the UI updates line by line
+                if buffered >= self.valves.STREAM_CHUNK_SIZE or "\n" in text:
+                    yield "".join(buffer)
+                    buffer = []
+                    buffered = 0
+
+            if buffer:
+                yield "".join(buffer)
+        except Exception as e:
+            # Runs after pipe() has returned, so errors must be reported here
+            logger.exception("Error streaming content")
+            if buffer:
+                yield "".join(buffer)
+            yield f"An error occurred: {str(e)}"